@@ -6,6 +6,7 @@ from peewee import Case, IntegrityError, fn
 from app.models.settings import SettingsGetModel, SettingsModel, SettingsPostModel
 from app.models.database.settings import Settings
 from app.security import is_setup_required
+from helpers.jellyfin import _invalidate_settings_cache
 
 from app.models.database.libraries import Libraries
 from app.models.database.users import Users
@@ -92,6 +93,9 @@ class SettingsListAPI(Resource):
                 elif value == "jellyfin" or value == "emby":
                     Requests.delete().where(Requests.service == "overseerr").execute()
 
+        # Drop cached media server settings so the new values are used
+        _invalidate_settings_cache()
+
         return response, 200
 
 
@@ -127,6 +131,7 @@ class SettingsAPI(Resource):
     @api.response(500, "Internal server error")
     def put(self, setting_id: str):
         Settings.update(value=request.data).where(Settings.key == setting_id).execute()
+        _invalidate_settings_cache()
 
         response = SettingsAPI.get(self, setting_id)
 
@@ -140,6 +145,7 @@ class SettingsAPI(Resource):
     @api.response(500, "Internal server error")
     def delete(self, setting_id: str):
         Settings.delete().where(Settings.key == setting_id).execute()
+        _invalidate_settings_cache()
 
         response = { "msg": f"Setting {setting_id} deleted successfully" }
 
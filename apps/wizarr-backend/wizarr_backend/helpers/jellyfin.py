@@ -1,19 +1,47 @@
 from typing import Optional
+from functools import lru_cache, partial
 
-from requests import RequestException, get, post, delete
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from logging import info
 from io import BytesIO
+from time import monotonic
+from urllib.parse import urljoin
 
-from app.models.database import Invitations
+from orjson import loads
+from peewee import chunked
+
+from app.models.database import Invitations, Users, db
 
 from .settings import get_media_settings
-from .users import get_users, create_user, get_user_by_token
+from .users import get_users
 
 from app.models.jellyfin.user import JellyfinUser
 from app.models.jellyfin.user_policy import JellyfinUserPolicy
 from app.models.jellyfin.library import JellyfinLibraryItem
 
+# Shared session so every Jellyfin API call reuses pooled keep-alive connections
+_SESSION = Session()
+_SESSION.headers.update({ "Accept": "application/json, profile=\"PascalCase\"", "Accept-Encoding": "gzip, deflate" })
+
+# Retry idempotent requests on transient gateway errors with backoff
+_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["GET", "DELETE"], raise_on_status=False))
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+# Connect and read timeouts in seconds for Jellyfin API calls
+_TIMEOUT = (3, 10)
+
+# Cached media settings as (expires_at, server_url, server_api_key)
+_settings_cache: Optional[tuple[float, str, str]] = None
+
 # INDEX OF FUNCTIONS
+# - Jellyfin Base URL
+# - Jellyfin Cached Settings
+# - Jellyfin Auth Headers
+# - Jellyfin Decode Response
+# - Jellyfin Request
 # - Jellyfin Get Request
 # - Jellyfin Post Request
 # - Jellyfin Delete Request
@@ -25,106 +53,124 @@ from app.models.jellyfin.library import JellyfinLibraryItem
 # - Jellyfin Delete User
 # - Jellyfin Sync Users
 
-# ANCHOR - Jellyfin Get Request
-def get_jellyfin(api_path: str, as_json: Optional[bool] = True, server_api_key: Optional[str] = None, server_url: Optional[str] = None):
-    """Get data from Jellyfin.
-    :param api_path: API path to get data from
-    :type api_path: str
+# ANCHOR - Jellyfin Base URL
+def _base_url(server_url: str) -> str:
+    """Normalize a Jellyfin URL so it always ends with exactly one slash.
+    :param server_url: Jellyfin URL
+    :type server_url: str
 
-    :param server_api_key: Jellyfin API key
-    :type server_api_key: Optional[str] - If not provided, will get from database.
+    :return: Normalized Jellyfin URL
+    """
 
-    :param server_url: Jellyfin URL
-    :type server_url: Optional[str] - If not provided, will get from database.
+    return str(server_url).rstrip("/") + "/"
 
-    :return: Jellyfin API response
+
+# ANCHOR - Jellyfin Cached Settings
+def _cached_settings(ttl: int = 30) -> tuple[str, str]:
+    """Get the Jellyfin URL and API key, only querying the database when the cache has expired.
+    :param ttl: Number of seconds to keep the settings cached
+    :type ttl: int
+
+    :return: Tuple of normalized server_url and server_api_key
     """
 
-    # Get required settings
-    if not server_api_key or not server_url:
+    global _settings_cache
+
+    # Refresh the cache from the database if it is empty or expired
+    if _settings_cache is None or _settings_cache[0] < monotonic():
         settings = get_media_settings()
-        server_url = server_url or settings.get("server_url", None)
-        server_api_key = server_api_key or settings.get("server_api_key", None)
+        server_url = settings.get("server_url", None)
+        _settings_cache = (monotonic() + ttl, _base_url(server_url) if server_url else None, settings.get("server_api_key", None))
 
-    # If server_url does not end with a slash, add one
-    if not server_url.endswith("/"):
-        server_url = server_url + "/"
+    return _settings_cache[1], _settings_cache[2]
 
-    # If api_path starts with a slash, remove it
-    if api_path.startswith("/"):
-        api_path = api_path[1:]
 
-    # Add api_path to Jellyfin URL
-    api_url = str(server_url) + api_path
+def _invalidate_settings_cache() -> None:
+    """Clear the cached Jellyfin settings so the next request reads them from the database."""
 
-    # Set headers for Jellyfin API
-    headers = {
-        "X-Emby-Token": server_api_key,
-        "Accept": "application/json, profile=\"PascalCase\""
-    }
+    global _settings_cache
+    _settings_cache = None
 
-    # Get data from Jellyfin
-    response = get(url=api_url, headers=headers, timeout=30)
 
-    # Raise exception if Jellyfin API returns non-2** status code
-    if not response.ok:
-        raise RequestException(
-            f"Jellyfin API returned {response.status_code} status code."
-        )
+# ANCHOR - Jellyfin Auth Headers
+@lru_cache(maxsize=4)
+def _auth_headers(server_api_key: str) -> dict[str, str]:
+    """Get the per-request headers for a Jellyfin API key, built once per key.
+    :param server_api_key: Jellyfin API key
+    :type server_api_key: str
 
-    # Return response
-    if as_json:
-        return response.json() if response.content else None
-    else:
-        return response if response.content else None
+    :return: Headers to pass to the session, must not be mutated
+    """
 
+    return { "X-Emby-Token": server_api_key }
 
-# ANCHOR - Jellyfin Post Request
-def post_jellyfin(api_path: str, server_api_key: Optional[str] = None, server_url: Optional[str] = None, json: Optional[dict] = None, data: Optional[any] = None):
-    """Post data to Jellyfin.
-    :param api_path: API path to post data to
+
+# ANCHOR - Jellyfin Decode Response
+def _decode(response: Response):
+    """Decode a Jellyfin JSON response with orjson.
+    :param response: Response from Jellyfin
+    :type response: Response
+
+    :return: Decoded JSON body
+    """
+
+    return loads(response.content)
+
+
+# ANCHOR - Jellyfin Request
+def _request(method: str, api_path: str, *, as_json: Optional[bool] = True, server_api_key: Optional[str] = None, server_url: Optional[str] = None, json: Optional[dict] = None, data: Optional[any] = None):
+    """Send a request to Jellyfin.
+    :param method: HTTP method to use
+    :type method: str
+
+    :param api_path: API path to send the request to
     :type api_path: str
 
+    :param as_json: Whether to decode the response body as JSON
+    :type as_json: Optional[bool]
+
     :param server_api_key: Jellyfin API key
     :type server_api_key: Optional[str] - If not provided, will get from database.
 
     :param server_url: Jellyfin URL
     :type server_url: Optional[str] - If not provided, will get from database.
 
-    :param data: Data to post to Jellyfin
-    :type data: Optional[dict]
+    :param json: JSON body to send to Jellyfin
+    :type json: Optional[dict]
 
-    :return: Jellyfin API response
+    :param data: Data to send to Jellyfin
+    :type data: Optional[any]
+
+    :return: Jellyfin API response, None if the response has no body
     """
 
     # Get required settings
     if not server_api_key or not server_url:
-        settings = get_media_settings()
-        server_url = server_url or settings.get("server_url", None)
-        server_api_key = server_api_key or settings.get("server_api_key", None)
+        cached_server_url, cached_server_api_key = _cached_settings()
+        server_url = server_url or cached_server_url
+        server_api_key = server_api_key or cached_server_api_key
 
     # Add api_path to Jellyfin URL
-    api_url = str(server_url) + api_path
-
-    # Set headers for Jellyfin API
-    headers = {
-        "X-Emby-Token": server_api_key,
-        "Accept": "application/json"
-    }
+    api_url = urljoin(_base_url(server_url), api_path.lstrip("/"))
 
-    # Post data to Jellyfin
-    response = post(url=api_url, headers=headers, data=data, json=json, timeout=30)
+    # Send request to Jellyfin
+    response = _SESSION.request(method, url=api_url, headers=_auth_headers(server_api_key), data=data, json=json, timeout=_TIMEOUT)
 
     # Raise exception if Jellyfin API returns non-2** status code
-    if not response.ok:
-        raise RequestException(
-            f"Jellyfin API returned {response.status_code} status code."
-        )
-
     response.raise_for_status()
 
-    return response.json() if response.content else None
+    # Return response
+    if not response.content:
+        return None
+
+    return _decode(response) if as_json else response
+
+
+# ANCHOR - Jellyfin Get Request
+get_jellyfin = partial(_request, "GET")
 
+# ANCHOR - Jellyfin Post Request
+post_jellyfin = partial(_request, "POST")
 
 # ANCHOR - Jellyfin Delete Request
 def delete_jellyfin(api_path: str, server_api_key: Optional[str] = None, server_url: Optional[str] = None) -> None:
@@ -141,31 +187,8 @@ def delete_jellyfin(api_path: str, server_api_key: Optional[str] = None, server_
     :return: None
     """
 
-    # Get required settings
-    if not server_api_key or not server_url:
-        settings = get_media_settings()
-        server_url = server_url or settings.get("server_url", None)
-        server_api_key = server_api_key or settings.get("server_api_key", None)
-
-    # Add api_path to Jellyfin URL
-    api_url = str(server_url) + api_path
-
-    # Set headers for Jellyfin API
-    headers = {
-        "X-Emby-Token": server_api_key,
-        "Accept": "application/json, profile=\"PascalCase\""
-    }
-
-    # Delete data from Jellyfin
-    response = delete(url=api_url, headers=headers, timeout=30)
-
-    # Raise exception if Jellyfin API returns non-2** status code
-    if not response.ok:
-        raise RequestException(
-            f"Jellyfin API returned {response.status_code} status code."
-        )
-
-    return response.json() if response.content else None
+    # Delete data from Jellyfin, the response body is not needed
+    _request("DELETE", api_path, as_json=False, server_api_key=server_api_key, server_url=server_url)
 
 
 # ANCHOR - Jellyfin Scan Libraries
@@ -255,9 +278,6 @@ def invite_jellyfin_user(username: str, password: str, code: str, server_api_key
     # Create user object
     new_user = { "Name": str(username), "Password": str(password) }
 
-    # Create user in Jellyfin
-    user_response = post_jellyfin(api_path="/Users/New", json=new_user, server_api_key=server_api_key, server_url=server_url)
-
     # Create policy object
     new_policy = {
         "EnableAllFolders": True,
@@ -284,17 +304,17 @@ def invite_jellyfin_user(username: str, password: str, code: str, server_api_key
     if invitation.hide_user is not None and invitation.hide_user == False:
         new_policy["IsHidden"] = False
 
+    # Create user in Jellyfin
+    user_response = post_jellyfin(api_path="/Users/New", json=new_user, server_api_key=server_api_key, server_url=server_url)
+
     # Get users default policy
     old_policy = user_response["Policy"]
 
     # Merge policy with user policy don't overwrite
     new_policy = {**old_policy, **new_policy}
 
-    # API path fpr user policy
-    api_path = f"/Users/{user_response['Id']}/Policy"
-
     # Update user policy
-    post_jellyfin(api_path=api_path, json=new_policy, server_api_key=server_api_key, server_url=server_url)
+    post_jellyfin(api_path=f"/Users/{user_response['Id']}/Policy", json=new_policy, server_api_key=server_api_key, server_url=server_url)
 
     # Return response
     return user_response
@@ -372,7 +392,7 @@ def sync_jellyfin_users(server_api_key: Optional[str] = None, server_url: Option
     :param server_url: Jellyfin URL
     :type server_url: Optional[str] - If not provided, will get from database.
 
-    :return: None
+    :return: Jellyfin users
     """
 
     # Get users from Jellyfin
@@ -381,23 +401,43 @@ def sync_jellyfin_users(server_api_key: Optional[str] = None, server_url: Option
     # Get users from database
     database_users = get_users(False)
 
-    # If jellyfin_users.id not in database_users.token, add to database
-    for jellyfin_user in jellyfin_users:
-        if str(jellyfin_user["Id"]) not in [str(database_user.token) for database_user in database_users]:
-            create_user(username=jellyfin_user["Name"], token=jellyfin_user["Id"])
-            info(f"User {jellyfin_user['Name']} successfully imported to database.")
+    # Map database users by token so the loop below does not query each user individually
+    database_users_by_token = { str(database_user.token): database_user for database_user in database_users }
+
+    # Set of Jellyfin user IDs for constant time lookups
+    jellyfin_user_ids = { str(jellyfin_user["Id"]) for jellyfin_user in jellyfin_users }
+
+    # Jellyfin users not in the database and database users no longer in Jellyfin
+    new_users = [jellyfin_user for jellyfin_user in jellyfin_users if str(jellyfin_user["Id"]) not in database_users_by_token]
+    stale_users = [database_user for database_user in database_users if str(database_user.token) not in jellyfin_user_ids]
+
+    # Apply all changes in a single transaction
+    with db.atomic():
+        # If jellyfin_users.id not in database_users.token, add to database
+        if new_users:
+            # Insert in batches to stay under SQLite's bound variable limit
+            for batch in chunked(new_users, 100):
+                Users.insert_many([{ Users.username: jellyfin_user["Name"], Users.token: jellyfin_user["Id"] } for jellyfin_user in batch]).execute()
+
+            for jellyfin_user in new_users:
+                info(f"User {jellyfin_user['Name']} successfully imported to database.")
 
         # If database_users.token in jellyfin_users.id, update the users name in database
-        else:
-            user = get_user_by_token(jellyfin_user["Id"], verify=False)
+        for jellyfin_user in jellyfin_users:
+            user = database_users_by_token.get(str(jellyfin_user["Id"]))
 
-            if (jellyfin_user["Name"] != user.username):
+            if user is not None and jellyfin_user["Name"] != user.username:
                 user.username = jellyfin_user["Name"]
                 user.save()
                 info(f"User {jellyfin_user['Name']} successfully updated in database.")
 
-    # If database_users.token not in jellyfin_users.id, delete from database
-    for database_user in database_users:
-        if str(database_user.token) not in [str(jellyfin_user["Id"]) for jellyfin_user in jellyfin_users]:
-            database_user.delete_instance()
-            info(f"User {database_user.username} successfully deleted from database.")
\ No newline at end of file
+        # If database_users.token not in jellyfin_users.id, delete from database
+        if stale_users:
+            for batch in chunked(stale_users, 100):
+                Users.delete().where(Users.id.in_([database_user.id for database_user in batch])).execute()
+
+            for database_user in stale_users:
+                info(f"User {database_user.username} successfully deleted from database.")
+
+    # Return the users already fetched from Jellyfin
+    return jellyfin_users